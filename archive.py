@@ -0,0 +1,198 @@
+# coding:utf-8
+"""SQLite archive of relayed lines.
+
+The IRC loop never touches the database.  Lines are handed to a writer
+thread which commits them in batches, and searches are run by a reader
+thread whose results are picked up by poll() on the IRC loop.
+"""
+
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS line (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    pipe TEXT NOT NULL,
+    network TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS line_fts USING fts5(
+    pipe UNINDEXED, message, content='line', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS line_ai AFTER INSERT ON line BEGIN
+    INSERT INTO line_fts (rowid, pipe, message)
+    VALUES (new.id, new.pipe, new.message);
+END;
+"""
+
+SEARCH_QUERY = """
+SELECT line.timestamp, line.network, line.channel, line.message
+FROM line_fts JOIN line ON line.id = line_fts.rowid
+WHERE line_fts MATCH 'message : (' || ? || ')' AND line.pipe = ?
+ORDER BY line_fts.rowid DESC
+LIMIT ? OFFSET ?
+"""
+
+def quote_terms(terms):
+    """Turn user input into an FTS5 query matching all of the terms.
+    Every term is quoted, so FTS5 operators in the input are not honored.
+
+    Example:
+    >>> quote_terms('foo OR bar')
+    '"foo" "OR" "bar"'
+    """
+    return ' '.join('"{}"'.format(_.replace('"', '""'))
+        for _ in terms.split())
+
+class Archive(object):
+    """Archive of relayed lines with a full-text index.
+
+    path -- SQLite database file name
+    batch_size -- number of lines committed at once
+    flush_interval -- maximum seconds a line waits before being committed
+    max_pending -- lines queued beyond this are dropped rather than
+                   blocking the bot
+    page_size -- number of results returned by a search
+    search_timeout -- seconds a search may run before it is interrupted
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0,
+                 max_pending=10000, page_size=5, search_timeout=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.page_size = page_size
+        self.search_timeout = search_timeout
+        self.dropped = 0
+        self.write_queue = queue.Queue(max_pending)
+        self.search_queue = queue.Queue()
+        self.result_queue = queue.Queue()
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+        self.writer = threading.Thread(target=self._write_loop,
+            name='archive-writer', daemon=True)
+        self.searcher = threading.Thread(target=self._search_loop,
+            name='archive-searcher', daemon=True)
+        self.writer.start()
+        self.searcher.start()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def write(self, pipe, network, channel, message):
+        """Queue a line for archiving.  Never blocks."""
+        try:
+            self.write_queue.put_nowait(
+                (time.time(), pipe, network, channel, message))
+        except queue.Full:
+            self.dropped += 1
+
+    def search(self, pipe, terms, page, callback):
+        """Queue a search.  callback(results, error) is called from poll()
+        with a list of (timestamp, network, channel, message) tuples,
+        newest first.
+        """
+        self.search_queue.put((pipe, terms, page, callback))
+
+    def poll(self):
+        """Deliver finished searches.  Call this from the IRC loop."""
+        while True:
+            try:
+                callback, results, error = self.result_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(results, error)
+            except Exception:
+                logging.exception('while delivering search results')
+
+    def close(self, timeout=1.0):
+        """Stop the threads, waiting at most *timeout* seconds for them to
+        flush pending lines and finish queued searches.  The threads are
+        left to finish in the background after that.
+        """
+        deadline = time.time() + timeout
+        try:
+            self.write_queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass # the writer is a daemon; it goes away with the bot
+        self.search_queue.put(None)
+        for thread in [self.writer, self.searcher]:
+            thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive():
+                logging.warning('{}: {} still running after {}s'.format(
+                    self.path, thread.name, timeout))
+        self.poll()
+        if self.dropped:
+            logging.warning('{}: dropped {} lines'.format(
+                self.path, self.dropped))
+
+    def _write_loop(self):
+        connection = self._connect()
+        done = False
+        while not done:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                try:
+                    row = self.write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    done = True
+                    break
+                batch.append(row)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            if not batch:
+                continue
+            try:
+                with connection:
+                    connection.executemany('INSERT INTO line (timestamp, '
+                        'pipe, network, channel, message) '
+                        'VALUES (?, ?, ?, ?, ?)', batch)
+            except sqlite3.Error:
+                logging.exception('while archiving {} lines'.format(
+                    len(batch)))
+        connection.close()
+
+    def _search_loop(self):
+        connection = self._connect()
+        while True:
+            request = self.search_queue.get()
+            if request is None:
+                break
+            pipe, terms, page, callback = request
+            deadline = time.time() + self.search_timeout
+            # bound the latency: sqlite aborts the query once this
+            # returns true
+            connection.set_progress_handler(
+                lambda: time.time() > deadline, 1000)
+            results, error = [], None
+            try:
+                results = connection.execute(SEARCH_QUERY, (
+                    quote_terms(terms), pipe, self.page_size,
+                    self.page_size * (page - 1))).fetchall()
+            except sqlite3.OperationalError as e:
+                error = 'search timed out' if 'interrupted' in str(e) \
+                    else str(e)
+            except sqlite3.Error as e:
+                error = str(e)
+            finally:
+                connection.set_progress_handler(None, 0)
+            self.result_queue.put((callback, results, error))
+        connection.close()
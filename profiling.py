@@ -0,0 +1,129 @@
+# coding:utf-8
+"""Hot path timing and on-demand profiling."""
+
+import os.path
+import time
+import signal
+import logging
+import cProfile
+import pstats
+import functools
+import collections
+
+slow_threshold = 0.1 # seconds; slower calls are logged to slow_log
+slow_log = logging.getLogger('uniko.slow')
+
+class Timing(object):
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+timings = collections.defaultdict(Timing)
+
+def timed(name, describe=None):
+    """Decorate a function so that its running time is accumulated in
+    timings[name].  Calls slower than slow_threshold are logged, along
+    with describe(*args) if given.
+    """
+    def decorator(f):
+        timing = timings[name]
+        @functools.wraps(f)
+        def new_f(*args):
+            start = time.perf_counter()
+            try:
+                return f(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                timing.count += 1
+                timing.total += elapsed
+                if elapsed > timing.max:
+                    timing.max = elapsed
+                if elapsed > slow_threshold:
+                    message = '{} took {:.3f}s'.format(name, elapsed)
+                    if describe:
+                        message += ': ' + describe(*args)
+                    slow_log.warning(message)
+        return new_f
+    return decorator
+
+def summary():
+    """Return the timings as lines of text, the most expensive first."""
+    lines = []
+    for name, timing in sorted(timings.items(),
+            key=lambda _: _[1].total, reverse=True):
+        if not timing.count:
+            continue
+        lines.append('{}: {} calls, {:.3f}s total, {:.6f}s mean, '
+            '{:.6f}s max'.format(name, timing.count, timing.total,
+                timing.total / timing.count, timing.max))
+    return lines
+
+class Profiler(object):
+    """Time-boxed cProfile session over the main loop.
+    Results are dumped to profile-<time>.prof in *directory*, with
+    a readable report alongside in profile-<time>.txt.
+    """
+
+    def __init__(self, directory, duration=30):
+        self.directory = directory
+        self.duration = duration
+        self.requested = None
+        self.profile = None
+        self.path = None
+        self.deadline = 0
+
+    def install_signal(self, signum=getattr(signal, 'SIGUSR1', None)):
+        """Start a session of the default duration upon the signal."""
+        if signum is None:
+            return # not available on this platform
+        signal.signal(signum, lambda *_: self.request())
+
+    def request(self, duration=None):
+        """Ask for a session to start on the next tick.
+        Safe to be called from a signal handler.
+        """
+        self.requested = duration or self.duration
+
+    def is_running(self):
+        return self.profile is not None
+
+    def start(self, duration=None):
+        """Start a session and return the file name it will be dumped to,
+        or None if a session is already running.
+        """
+        if self.is_running():
+            return None
+        duration = duration or self.duration
+        self.path = os.path.join(self.directory, time.strftime(
+            'profile-%Y%m%d-%H%M%S.prof'))
+        self.deadline = time.time() + duration
+        self.profile = cProfile.Profile()
+        logging.info('profiling for {}s into {}'.format(duration, self.path))
+        self.profile.enable()
+        return self.path
+
+    def stop(self):
+        if not self.is_running():
+            return
+        self.profile.disable()
+        try:
+            self.profile.dump_stats(self.path)
+            with open(os.path.splitext(self.path)[0] + '.txt', 'w') as f:
+                f.write('\n'.join(summary()) + '\n\n')
+                stats = pstats.Stats(self.profile, stream=f)
+                stats.sort_stats('cumulative').print_stats(50)
+            logging.info('profile dumped to {}'.format(self.path))
+        except OSError:
+            logging.exception('while dumping profile to {}'.format(self.path))
+        finally:
+            self.profile = None
+
+    def on_tick(self):
+        if self.requested:
+            duration, self.requested = self.requested, None
+            self.start(duration)
+        if self.is_running() and time.time() >= self.deadline:
+            self.stop()
@@ -0,0 +1,93 @@
+# coding:utf-8
+"""Server selection and backoff for reconnecting bots."""
+
+import time
+import random
+
+class ServerState(object):
+    """What a bot knows about one entry of the server list."""
+
+    def __init__(self, address):
+        self.address = address
+        self.latency = None # seconds from connecting to the welcome
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def is_healthy(self, now):
+        return self.retry_at <= now
+
+class Reconnector(object):
+    """Decide which server a bot connects to next, and when.
+
+    A failing server is put aside with exponential backoff and the next
+    healthy one is tried right away; among the healthy servers the one
+    with the lowest measured latency is preferred.  All delays are
+    jittered so the bots of a network do not reconnect in lockstep.
+
+    server_list -- list of (host, port[, password]) tuples
+    base_interval -- backoff after the first failure of a server
+    max_interval -- backoff never grows beyond this
+    """
+
+    smoothing = 0.3 # weight of a new latency sample
+
+    def __init__(self, server_list, base_interval=2.0, max_interval=600.0):
+        self.servers = [ServerState(_) for _ in server_list]
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.current = None
+        self.started = 0.0
+
+    def _backoff(self, failures):
+        limit = min(self.max_interval,
+            self.base_interval * 2 ** min(failures - 1, 32))
+        return limit / 2 + random.uniform(0, limit / 2)
+
+    def ordered(self):
+        """Return the server addresses, the one to try next first."""
+        now = time.time()
+        def key(server):
+            if not server.is_healthy(now):
+                return (2, server.retry_at)
+            if server.latency is None:
+                return (1, 0.0) # keeps the configured order
+            return (0, server.latency)
+        return [_.address for _ in sorted(self.servers, key=key)]
+
+    def delay(self):
+        """Return seconds to wait before the next attempt."""
+        now = time.time()
+        jitter = random.uniform(0, self.base_interval)
+        if any(_.is_healthy(now) for _ in self.servers):
+            return jitter
+        retry_at = min(_.retry_at for _ in self.servers)
+        return max(retry_at - now, 0) + jitter
+
+    def connecting(self, address):
+        for server in self.servers:
+            if server.address == address:
+                self.current = server
+                break
+        self.started = time.time()
+
+    def connected(self):
+        """The current server welcomed us."""
+        server = self.current
+        if server is None:
+            return
+        latency = time.time() - self.started
+        if server.latency is None:
+            server.latency = latency
+        else:
+            server.latency += self.smoothing * (latency - server.latency)
+        server.failures = 0
+        server.retry_at = 0.0
+
+    def failed(self):
+        """The current server could not be reached or dropped us."""
+        server = self.current
+        if server is None:
+            return
+        server.failures += 1
+        server.retry_at = time.time() + self._backoff(server.failures)
+        self.current = None
@@ -0,0 +1,102 @@
+# coding:utf-8
+"""Fixed-size scrollback of relayed lines."""
+
+import time
+import array
+
+class Scrollback(object):
+    """Ring buffer of the last *capacity* lines.
+
+    Lines are kept UTF-8 encoded in a single preallocated bytearray, cut to
+    *line_size* bytes, and nicknames are interned into a table holding at
+    most *capacity* entries, so the memory use is fixed at creation:
+    roughly capacity * (line_size + 16) bytes plus the nicknames.
+    """
+
+    def __init__(self, capacity, line_size=256):
+        assert capacity > 0 and 0 < line_size < 2 ** 16
+        self.capacity = capacity
+        self.line_size = line_size
+        self.data = bytearray(capacity * line_size)
+        self.lengths = array.array('H', [0]) * capacity
+        self.timestamps = array.array('d', [0.0]) * capacity
+        self.nick_ids = array.array('l', [-1]) * capacity
+        self.nicks = [] # nick id -> nickname
+        self.nick_index = {} # nickname -> nick id
+        self.nick_refs = array.array('L')
+        self.free_nick_ids = []
+        self.head = 0 # next slot to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _intern(self, nickname):
+        nick_id = self.nick_index.get(nickname)
+        if nick_id is None:
+            if self.free_nick_ids:
+                nick_id = self.free_nick_ids.pop()
+                self.nicks[nick_id] = nickname
+            else:
+                nick_id = len(self.nicks)
+                self.nicks.append(nickname)
+                self.nick_refs.append(0)
+            self.nick_index[nickname] = nick_id
+        self.nick_refs[nick_id] += 1
+        return nick_id
+
+    def _release(self, nick_id):
+        self.nick_refs[nick_id] -= 1
+        if self.nick_refs[nick_id]:
+            return
+        del self.nick_index[self.nicks[nick_id]]
+        self.nicks[nick_id] = None
+        self.free_nick_ids.append(nick_id)
+
+    def push(self, nickname, line, timestamp=None):
+        """Store a line, overwriting the oldest one when full.
+        Arguments:
+        nickname -- nickname in bytes
+        line -- the line as relayed, in str
+        """
+        assert isinstance(nickname, bytes)
+        slot = self.head
+        if self.size == self.capacity:
+            self._release(self.nick_ids[slot])
+        else:
+            self.size += 1
+        encoded = line.encode('utf-8')[:self.line_size]
+        offset = slot * self.line_size
+        self.data[offset:offset + len(encoded)] = encoded
+        self.lengths[slot] = len(encoded)
+        self.timestamps[slot] = time.time() if timestamp is None \
+            else timestamp
+        self.nick_ids[slot] = self._intern(nickname)
+        self.head = (slot + 1) % self.capacity
+
+    def last(self, count, nickname=None):
+        """Return up to *count* latest lines as (timestamp, nickname, line)
+        tuples, oldest first.  If *nickname* is given, only lines from
+        that nickname are returned.
+        """
+        nick_id = None
+        if nickname is not None:
+            nick_id = self.nick_index.get(nickname)
+            if nick_id is None:
+                return []
+        result = []
+        for i in range(1, self.size + 1):
+            if len(result) >= count:
+                break
+            slot = (self.head - i) % self.capacity
+            if nick_id is not None and self.nick_ids[slot] != nick_id:
+                continue
+            offset = slot * self.line_size
+            line = self.data[offset:offset + self.lengths[slot]]
+            result.append((
+                self.timestamps[slot],
+                self.nicks[self.nick_ids[slot]],
+                # a cut may have split the last character
+                line.decode('utf-8', 'ignore')))
+        result.reverse()
+        return result
@@ -15,10 +15,15 @@ import logging
 import traceback
 
 import irclib
+import ircbot
 from BufferingBot import Message, MessageBuffer, BufferingBot
 
+import archive
 import formatter
 import formatter.standard
+import profiling
+import reconnect
+import scrollback
 import util
 
 class Network(object):
@@ -26,13 +31,21 @@ class Network(object):
     Also works as a message buffer when the bots are running.
     """
 
-    def __init__(self, server_list, name, encoding, use_ssl=False):
+    def __init__(self, server_list, name, encoding, use_ssl=False,
+                 reconnection_interval=600):
+        """
+        reconnection_interval -- the longest a bot waits before retrying
+                                 an unreachable server; 0 or less means
+                                 never reconnect, as in ircbot
+        """
         self.server_list = server_list
         self.name = name
         self.encoding = encoding
         self.bots = []
         self.use_ssl = use_ssl
+        self.reconnection_interval = reconnection_interval
 
+    @profiling.timed('Network.encode')
     def encode(self, string):
         """Safely encode the string using the network's encoding."""
         result = string.encode(self.encoding, 'xmlcharrefreplace')
@@ -48,7 +61,7 @@ class Network(object):
             self,
             nickname=self.encode(nickname)[0],
             realname=b'Uniko the bot',
-            reconnection_interval=600,
+            reconnection_interval=self.reconnection_interval,
             use_ssl=self.use_ssl,
             test_mode=test_mode)
         self.bots.append(bot)
@@ -60,6 +73,10 @@ class Network(object):
         nicknames = [bot.connection.get_nickname() for bot in self.bots]
         return nickname in nicknames
 
+    def is_reachable(self):
+        """Tell whether any of self.bots is registered to a server."""
+        return any(bot.registered for bot in self.bots)
+
     def is_listening_bot(self, bot, channel):
         """Tell whether the bot is on of the "listening bots" for the channel.
         """
@@ -107,12 +124,19 @@ class Network(object):
 class StandardPipe:
     def __init__(self, networks, channels, passwords=None,
                  disabled=None, always=None, never=None,
-                 formatter_='standard',
-                 weight=1, buffer_timeout=10.0, debug=False):
+                 formatter_='standard', archive_=None,
+                 scrollback_=0, scrollback_line_size=256,
+                 weight=1, buffer_timeout=10.0, debug=False,
+                 profiler=None, admins=None):
         """
         networks -- list of networks
         channels -- either string or a list of strings.
                     the length of the list must equal to the length of networks
+        archive_ -- archive.Archive instance, or None
+        scrollback_ -- number of lines kept for replay, 0 to disable
+        scrollback_line_size -- bytes kept per line of the scrollback
+        profiler -- profiling.Profiler instance started by \\profile
+        admins -- hostmasks allowed to use \\profile
         """
         self.networks = networks
         self.debug = debug
@@ -122,6 +146,11 @@ class StandardPipe:
         self.buffers = {}
         self.disabled = {}
         self.formatter = formatter.load(formatter_)
+        if self.formatter:
+            self.formatter = profiling.timed(
+                'formatter.' + formatter_)(self.formatter)
+        self.profiler = profiler
+        self.admins = admins or []
         for i, network in enumerate(networks):
             self.buffers[network] = MessageBuffer(timeout=buffer_timeout)
             if isinstance(channels, (list, tuple)):
@@ -151,6 +180,15 @@ class StandardPipe:
         self.weight = weight
         self.handler_function = {}
         self.join_tick = 0
+        self.paused = set()
+        self.dropped = collections.Counter() # by network, while paused
+        self.name = ' '.join(sorted('{}/{}'.format(network.name, channel)
+            for network, channel in self.channels.items()))
+        self.archive = archive_
+        self.scrollback = None
+        if scrollback_:
+            self.scrollback = scrollback.Scrollback(scrollback_,
+                line_size=scrollback_line_size)
 
     def attach_bot(self, bot, network):
         def _handler(_, event):
@@ -171,6 +209,7 @@ class StandardPipe:
     def on_tick(self):
         tick = time.time()
         self._sync_weight(tick)
+        self._sync_paused()
 
     def _sync_weight(self, tick):
         """should only be called from self.on_tick()"""
@@ -201,6 +240,22 @@ class StandardPipe:
                 bot.push_message(Message(command='join',
                     arguments=(channel, password)))
 
+    def _sync_paused(self):
+        """should only be called from self.on_tick()"""
+        for network in self.networks:
+            reachable = network.is_reachable()
+            if not reachable and network not in self.paused:
+                logging.info('{}: pausing {}'.format(self.name, network.name))
+                self.paused.add(network)
+            elif reachable and network in self.paused:
+                logging.info('{}: resuming {}'.format(self.name, network.name))
+                self.paused.remove(network)
+                if self.dropped[network]:
+                    logging.warning('{}: dropped {} messages to {}'.format(
+                        self.name, self.dropped.pop(network), network.name))
+
+    @profiling.timed('StandardPipe.handle',
+        describe=lambda self, bot, event: self.repr_event(event))
     def handle(self, bot, event):
         network = bot.network
         if network not in self.networks:
@@ -243,6 +298,12 @@ class StandardPipe:
         msg = self.formatter(event, network.get_channel(event.target()), network.encoding)
         if not msg:
             return False
+        if self.archive:
+            self.archive.write(self.name, network.name,
+                network.decode(target)[0], msg)
+        if self.scrollback is not None:
+            self.scrollback.push(
+                self.scrollback_nickname(network, nickname), msg)
         for target_network in self.networks:
             if target_network == network:
                 continue
@@ -277,6 +338,12 @@ class StandardPipe:
             return self.handle_op(bot, event, arg)
         if cmd == b'aop':
             return self.handle_aop(bot, event, arg)
+        if cmd == b'search':
+            return self.handle_search(bot, event, arg)
+        if cmd == b'last':
+            return self.handle_last(bot, event, arg)
+        if cmd == b'profile':
+            return self.handle_profile(bot, event, arg)
         return False
 
     def handle_who(self, bot, event, arg):
@@ -361,6 +428,134 @@ class StandardPipe:
                 arguments=(network.decode(nickname)[0], message)))
         return True
 
+    def handle_search(self, bot, event, arg):
+        r"""search the archive of the channel.
+        Usage: /msg uniko \search channel [page] terms
+               channel -- channel name (as seen from the user)
+               page -- page number, 1 by default
+               terms -- words that should all appear in the line
+        """
+        if not self.archive:
+            return False
+        channel, _, terms = arg.strip().partition(b' ')
+        channel = irclib.irc_lower(channel)
+        if not self.check_channel(bot, channel):
+            return False
+        network = bot.network
+        channel_obj = network.get_channel(network.decode(channel)[0])
+        nickname = irclib.nm_to_n(event.source() or b'')
+        if not channel_obj or not channel_obj.has_user(nickname):
+            return False
+        page, _, rest = terms.strip().partition(b' ')
+        if page.isdigit() and rest.strip():
+            page, terms = max(int(page), 1), rest
+        else:
+            page = 1
+        terms = network.decode(terms)[0]
+        if not terms.strip():
+            return False
+        target = network.decode(nickname)[0]
+        def reply(results, error):
+            if error:
+                lines = ['Search failed: {}'.format(error)]
+            elif not results:
+                lines = ['No more results for "{}"'.format(terms)]
+            else:
+                lines = ['[{time}] {network} {channel} {message}'.format(
+                    time=time.strftime('%Y-%m-%d %H:%M',
+                        time.localtime(timestamp)),
+                    network=network_name,
+                    channel=channel_name,
+                    message=message)
+                    for timestamp, network_name, channel_name, message
+                    in results]
+            for line in lines:
+                bot.push_message(Message(
+                    command='privmsg',
+                    arguments=(target, line)))
+        self.archive.search(self.name, terms, page, reply)
+        return True
+
+    def handle_last(self, bot, event, arg):
+        r"""replay the latest lines of the channel.
+        The lines are sent at low priority, after the relayed messages,
+        and only as many as can be sent before the low buffer times out.
+        Usage: /msg uniko \last channel [count [nickname]]
+               channel -- channel name (as seen from the user)
+               count -- number of lines, 10 by default
+               nickname -- only replay lines from the nickname
+        """
+        if self.scrollback is None:
+            return False
+        channel, count, nick_filter = (arg.split() + [None, None])[:3]
+        channel = irclib.irc_lower(channel or b'')
+        if not self.check_channel(bot, channel):
+            return False
+        network = bot.network
+        channel_obj = network.get_channel(network.decode(channel)[0])
+        nickname = irclib.nm_to_n(event.source() or b'')
+        if not channel_obj or not channel_obj.has_user(nickname):
+            return False
+        count = int(count) if count and count.isdigit() else 10
+        count = min(count, self.scrollback.capacity)
+        if nick_filter is not None:
+            nick_filter = self.scrollback_nickname(network, nick_filter)
+        lines = self.scrollback.last(count, nick_filter)
+        target = network.decode(nickname)[0]
+        room = bot.low_buffer_room()
+        if not lines or len(lines) > room:
+            if not lines:
+                msg = 'Nothing to replay'
+            elif not room:
+                msg = 'Too busy to replay now; try again later'
+            else:
+                msg = 'Replaying only the last {} of {} lines'.format(
+                    room, len(lines))
+            bot.push_message(Message(
+                command='privmsg',
+                arguments=(target, msg)))
+            lines = lines[len(lines) - room:] if room else []
+        for timestamp, _, line in lines:
+            bot.push_low_message(Message(
+                command='privmsg',
+                arguments=(target, '[{}] {}'.format(
+                    time.strftime('%H:%M', time.localtime(timestamp)),
+                    line))))
+        return True
+
+    def handle_profile(self, bot, event, arg):
+        r"""profile the bot for a while and dump the result to a file.
+        Only available to the admins.
+        Usage: /msg uniko \profile [seconds]
+               seconds -- duration of the profiling
+        """
+        if not self.profiler or not self.is_admin(bot, event):
+            return False
+        arg = arg.strip()
+        duration = int(arg) if arg.isdigit() else None
+        path = self.profiler.start(duration)
+        if path:
+            msg = 'Profiling into {}'.format(path)
+        else:
+            msg = 'Already profiling into {}'.format(self.profiler.path)
+        nickname = irclib.nm_to_n(event.source() or b'')
+        bot.push_message(Message(
+            command='privmsg',
+            arguments=(bot.network.decode(nickname)[0], msg)))
+        return True
+
+    def is_admin(self, bot, event):
+        """check if the source of the event matches one of self.admins."""
+        source = event.source() or b''
+        return any(irclib.mask_matches(source, bot.network.encode(_)[0])
+            for _ in self.admins)
+
+    def scrollback_nickname(self, network, nickname):
+        """normalize the nickname from the network for self.scrollback,
+        so that it matches regardless of the network's encoding and case.
+        """
+        return network.decode(irclib.irc_lower(nickname))[0].encode('utf-8')
+
     def check_channel(self, bot, channel):
         """check if the channel should be handled by self."""
         channel = bot.network.decode(irclib.irc_lower(channel))[0]
@@ -374,6 +569,10 @@ class StandardPipe:
         """
         if self.disabled.get(network, False):
             return
+        if network in self.paused:
+            # nobody to deliver it; don't let it pile up
+            self.dropped[network] += 1
+            return
         self.buffers[network].push(message)
 
     def repr_nickname(self, nickname, channel_obj):
@@ -418,28 +617,91 @@ class StandardPipe:
         return ' '.join(repr(_) for _ in result)
 
 class UnikoBufferingBot(BufferingBot):
+    registration_timeout = 60 # seconds to wait for the welcome
+    send_interval = 2.0 # seconds per message flood control allows, at least
+
     def __init__(self, network, nickname, realname, reconnection_interval=60,
-                 use_ssl=False, buffer_timeout=10.0, test_mode=False):
+                 use_ssl=False, buffer_timeout=10.0, test_mode=False,
+                 low_buffer_timeout=60.0):
         self.ext_buffers = set()
+        self.low_buffer_timeout = low_buffer_timeout
+        self.low_buffer = MessageBuffer(timeout=low_buffer_timeout)
         self.network = network
         self.test_mode = test_mode
-        BufferingBot.__init__(self, network.server_list, nickname,
+        self.reconnect_enabled = reconnection_interval > 0
+        self.reconnector = reconnect.Reconnector(network.server_list,
+            max_interval=max(reconnection_interval, 0))
+        self.registered = False
+        self.reconnect_pending = False
+        self.connect_attempt = 0
+        BufferingBot.__init__(self, list(network.server_list), nickname,
             username=b'uniko', realname=b'Uniko the bot',
             reconnection_interval=reconnection_interval, use_ssl=use_ssl,
             codec=network, buffer_timeout=buffer_timeout, passive=True)
         self.handlers = {}
         self.handler_wrapper = {}
+        self.connection.add_global_handler('welcome', self._on_welcome, -20)
 
     def __lt__(self, bot):
         return hash(self) < hash(bot)
 
+    def _connect(self):
+        """connect to the best server at the moment.
+        Overrides the round robin of ircbot with self.reconnector.
+        """
+        self.connect_attempt += 1
+        self.server_list = self.reconnector.ordered()
+        self.reconnector.connecting(self.server_list[0])
+        BufferingBot._connect(self)
+        if not self.connection.is_connected():
+            self._connection_failed()
+            return
+        self.ircobj.execute_delayed(self.registration_timeout,
+            self._registration_checker, (self.connect_attempt,))
+
+    def _connection_failed(self):
+        self.registered = False
+        self.reconnector.failed()
+        if self.reconnect_pending or not self.reconnect_enabled:
+            return
+        self.reconnect_pending = True
+        self.ircobj.execute_delayed(self.reconnector.delay(),
+            self._connected_checker)
+
+    def _connected_checker(self):
+        self.reconnect_pending = False
+        if not self.connection.is_connected():
+            self._connect()
+
+    def _registration_checker(self, attempt):
+        if self.registered or attempt != self.connect_attempt:
+            return # welcomed, or a later attempt is under way
+        if self.connection.is_connected():
+            logging.info('{} got no welcome from {}'.format(
+                self.network.name, self.server_list[0]))
+            self.connection.disconnect('Registration timed out')
+
+    def _on_welcome(self, c, e):
+        self.registered = True
+        self.reconnector.connected()
+
+    def _on_disconnect(self, c, e):
+        # instead of waiting for reconnection_interval, fail over at once
+        self.channels = ircbot.IRCDict()
+        self._connection_failed()
+
+    @profiling.timed('UnikoBufferingBot.flood_control')
     def flood_control(self):
         if BufferingBot.flood_control(self):
             return True
-        if not self.ext_buffers:
-            return False
-        self.pop_buffer(min(self.ext_buffers))
-        return True
+        if any(len(_) for _ in self.ext_buffers):
+            self.pop_buffer(min(self.ext_buffers))
+            return True
+        if len(self.low_buffer):
+            # only when there is nothing else to send
+            self.pop_buffer(self.low_buffer)
+            return True
+        return False
 
     def attach_handler(self, action, handler):
         if action in self.handlers:
@@ -478,6 +740,17 @@ class UnikoBufferingBot(BufferingBot):
         self.handler_wrapper = {}
         self.handlers = {}
 
+    def push_low_message(self, message):
+        """push message which should wait for every other buffer."""
+        self.low_buffer.push(message)
+
+    def low_buffer_room(self):
+        """Return how many more messages the low buffer can take before
+        they would time out, even with no other traffic.
+        """
+        capacity = int(self.low_buffer_timeout / self.send_interval)
+        return max(capacity - len(self.low_buffer), 0)
+
     def add_buffer(self, message_buffer):
         self.ext_buffers.add(message_buffer)
 
@@ -499,10 +772,14 @@ class UnikoBot():
         self.networks = {}
         self.bots = collections.defaultdict(list)
         self.pipes = []
+        self.archives = {} # by file name, kept across reloads
         self.config_file_name = config_file_name
         self.config_timestamp = self._get_config_time()
         self.version = -1
         self.debug = False
+        self.admins = []
+        self.profiler = profiling.Profiler(
+            os.path.dirname(os.path.abspath(config_file_name)))
         self.load()
 
     def _get_config_time(self):
@@ -520,6 +797,7 @@ class UnikoBot():
         return None
 
     def start(self):
+        self.profiler.install_signal()
         for _ in self.bots.values():
             for bot in _:
                 logging.info('{0._nickname} connecting to {0.server_list}'.format(bot))
@@ -531,6 +809,9 @@ class UnikoBot():
                     bot.on_tick()
             for pipe in self.pipes:
                 pipe.on_tick()
+            for archive_ in self.archives.values():
+                archive_.poll()
+            self.profiler.on_tick()
             if self._get_config_time() > self.config_timestamp:
                 self.reload()
 
@@ -541,6 +822,7 @@ class UnikoBot():
         self.version = data['version']
         self.debug = data.get('debug', False)
         self.test_mode = data.get('test', False)
+        self.load_profiling(data)
         self.load_network(data['network'])
         self.load_bot(data['bot'])
         self.load_pipe(data['pipe'])
@@ -554,11 +836,18 @@ class UnikoBot():
         self.version = data['version']
         self.debug = data.get('debug', False)
         self.test_mode = data.get('test', False)
+        self.load_profiling(data)
         self.reload_network(data['network'])
         self.reload_bot(data['bot'])
         self.reload_pipe(data['pipe'])
         return True
 
+    def load_profiling(self, data):
+        self.admins = data.get('admin', [])
+        profiling.slow_threshold = data.get('slow_threshold', 0.1)
+        if 'profile_dir' in data:
+            self.profiler.directory = data['profile_dir']
+
     def reload_network(self, data):
         pass # TODO
 
@@ -568,7 +857,9 @@ class UnikoBot():
                 network_data['server'],
                 name=network_data['name'],
                 encoding=network_data['encoding'],
-                use_ssl=network_data.get('use_ssl', False))
+                use_ssl=network_data.get('use_ssl', False),
+                reconnection_interval=network_data.get(
+                    'reconnection_interval', 600))
 
     def reload_bot(self, data):
         pass # TODO
@@ -589,6 +880,18 @@ class UnikoBot():
             pipe.detach_all_handlers()
         self.pipes = []
         self.load_pipe(data)
+        in_use = set(pipe_data.get('archive') for pipe_data in data)
+        for path in list(self.archives):
+            if path not in in_use:
+                self.archives.pop(path).close()
+
+    def get_archive(self, path):
+        """Return the archive for the file name, opening it if needed."""
+        if not path:
+            return None
+        if path not in self.archives:
+            self.archives[path] = archive.Archive(path)
+        return self.archives[path]
 
     def load_pipe(self, data):
         for pipe_data in data:
@@ -600,9 +903,15 @@ class UnikoBot():
                 always=pipe_data.get('always', []),
                 never=pipe_data.get('never', []),
                 formatter_=pipe_data.get('formatter', 'standard'),
+                archive_=self.get_archive(pipe_data.get('archive')),
+                scrollback_=pipe_data.get('scrollback', 0),
+                scrollback_line_size=pipe_data.get(
+                    'scrollback_line_size', 256),
                 weight=pipe_data.get('weight', 1),
                 buffer_timeout=pipe_data.get('buffer_timeout', 10.0),
-                debug=self.debug)
+                debug=self.debug,
+                profiler=self.profiler,
+                admins=self.admins)
             for network in pipe_data['network']:
                 for bot in self.bots[network]:
                     pipe.attach_bot(bot, self.networks[network])